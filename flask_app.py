@@ -1,13 +1,23 @@
 import os
 import csv
+import codecs
 import io
 import json
+import math
+import re
 import time
+import socket
+import uuid
+import threading
 import requests
 from functools import wraps
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
 from flask import Flask, render_template_string, request, redirect, url_for, flash, jsonify, session, make_response
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
 
 app = Flask(__name__)
 # 生产环境建议修改密钥
@@ -38,6 +48,40 @@ class Domain(db.Model):
     last_checked = db.Column(db.DateTime, default=datetime.utcnow)
     position = db.Column(db.Integer, default=0)
 
+    # 跳转缓存: 记录最终落地地址，后续直接探测，省去 http -> https 等跳转
+    final_url = db.Column(db.String(300), default="")
+    redirect_hops = db.Column(db.Integer, default=0)
+    redirect_ms = db.Column(db.Integer, default=0)
+    redirect_checked = db.Column(db.DateTime)
+
+    # 内容断言: 200 也可能是停放页/错误页，按需校验页面内容
+    must_contain = db.Column(db.String(200), default="")
+    must_not_contain = db.Column(db.String(200), default="")
+    assert_regex = db.Column(db.Boolean, default=False)
+    max_body_kb = db.Column(db.Integer, default=0)
+
+    # 分层巡检: tcp = 仅做端口连通检测, http = 完整探测
+    check_tier = db.Column(db.String(10), default="")
+    tcp_alive = db.Column(db.Boolean)
+    last_deep_check = db.Column(db.DateTime)
+
+    # SLA 摘要 (JSON)，每次写入探测结果时更新，仪表盘直接读取
+    sla = db.Column(db.Text, default="")
+    stats = db.relationship('DomainStats', uselist=False, cascade='all, delete-orphan')
+
+    @property
+    def sla_stats(self):
+        return json.loads(self.sla) if self.sla else {}
+
+class DomainStats(db.Model):
+    """域名可用性与延迟的滚动统计，按小时/按天分桶增量维护"""
+    domain_id = db.Column(db.Integer, db.ForeignKey('domain.id'), primary_key=True)
+    buckets = db.Column(db.Text, default="{}")
+    down_since = db.Column(db.DateTime)
+    # 上一次检测的时间与结果，用于按时长累计在线/离线秒数
+    last_at = db.Column(db.DateTime)
+    last_online = db.Column(db.Boolean)
+
 class Config(db.Model):
     """存储用户的配置信息 (单行表)"""
     id = db.Column(db.Integer, primary_key=True)
@@ -48,6 +92,10 @@ class Config(db.Model):
     webdav_url = db.Column(db.String(200), default="")
     webdav_user = db.Column(db.String(100), default="")
     webdav_pass = db.Column(db.String(100), default="")
+    # 修改域名后自动备份到已配置的云端
+    auto_backup = db.Column(db.Boolean, default=False)
+    # 分层巡检租约，防止定时任务与页面按钮同时巡检
+    sweep_started = db.Column(db.DateTime)
 
 # --- 辅助函数 ---
 def login_required(f):
@@ -67,17 +115,377 @@ def get_config():
         db.session.commit()
     return conf
 
-def check_website_detailed(domain):
+# 跳转链重新校验间隔 (秒)，期间直接探测缓存的落地地址
+REDIRECT_REVALIDATE = 6 * 3600
+# 内容断言最多读取的字节数，超过即停止下载
+CONTENT_READ_CAP = 256 * 1024
+
+def content_rules(d):
+    """从域名记录提取内容断言，未配置时返回 None (探测时不读取正文)"""
+    if not (d.must_contain or d.must_not_contain or d.max_body_kb):
+        return None
+    return {
+        'contain': d.must_contain or '',
+        'not_contain': d.must_not_contain or '',
+        'regex': bool(d.assert_regex),
+        'max_bytes': (d.max_body_kb or 0) * 1024
+    }
+
+def check_content(r, rules):
+    """流式读取正文并校验断言，结论确定即停止。通过返回 None，否则返回原因
+
+    关键字只在前 CONTENT_READ_CAP 字节内查找；配置了体积上限时，超出部分只计数不缓存。
+    """
+    def match(pattern, text):
+        if rules['regex']:
+            return re.search(pattern, text) is not None
+        return pattern in text
+
+    max_bytes = rules['max_bytes']
+    length = r.headers.get('Content-Length', '')
+    if max_bytes and length.isdigit() and int(length) > max_bytes:
+        return '页面过大'
+    # 未显式声明 charset 时 requests 会按 HTTP 默认的 ISO-8859-1 解码，中文关键字永远匹配不上
+    encoding = r.encoding if 'charset' in r.headers.get('Content-Type', '').lower() else 'utf-8'
+    try:
+        codecs.lookup(encoding)
+    except LookupError:
+        encoding = 'utf-8'
+    buf = b''
+    total = 0
+    found = not rules['contain']
+    text_done = not (rules['contain'] or rules['not_contain'])
+    for chunk in r.iter_content(chunk_size=16 * 1024):
+        total += len(chunk)
+        if max_bytes and total > max_bytes:
+            return '页面过大'
+        if not text_done:
+            buf += chunk[:CONTENT_READ_CAP - len(buf)]
+            text = buf.decode(encoding, errors='ignore')
+            if rules['not_contain'] and match(rules['not_contain'], text):
+                return '含禁止内容'
+            if not found:
+                found = match(rules['contain'], text)
+            # 关键字结论已确定: 已命中且无禁止项，或已读满上限
+            if (found and not rules['not_contain']) or len(buf) >= CONTENT_READ_CAP:
+                text_done = True
+                if not found:
+                    return '缺少关键字'
+        if text_done and not max_bytes:
+            return None
+    if not found:
+        return '缺少关键字'
+    return None
+
+def check_website_detailed(domain, cached_url=None, rules=None):
+    """返回 (是否在线, 状态码, 耗时ms, 跳转信息)
+
+    传入 cached_url 时先直接探测该地址 (不跟随跳转)；若请求失败、出现新的跳转
+    或返回错误码，则回退为从 http:// 开始的完整探测。跳转信息仅在完整探测时返回，
+    格式为 {'final_url', 'hops', 'redirect_ms'}，直接探测命中时为 None。
+    rules 为 content_rules() 的结果，断言失败时视为离线，状态码附带原因。
+    耗时按收到响应头计算，不含正文下载。
+    """
+    headers = {'User-Agent': 'Mozilla/5.0 (DomainMonitor/1.0)'}
+
+    def finish(r, duration, redirect):
+        reason = check_content(r, rules) if rules else None
+        if reason:
+            return False, f'{r.status_code} {reason}', duration, redirect
+        return True, str(r.status_code), duration, redirect
+
+    if cached_url:
+        try:
+            start_time = time.time()
+            with requests.get(cached_url, timeout=5, headers=headers, allow_redirects=False, stream=True) as r:
+                duration = int((time.time() - start_time) * 1000)
+                if not r.is_redirect and r.status_code < 400:
+                    return finish(r, duration, None)
+        except Exception:
+            pass
+
     url = domain
     if not url.startswith('http'): url = f'http://{url}'
-    headers = {'User-Agent': 'Mozilla/5.0 (DomainMonitor/1.0)'}
     try:
         start_time = time.time()
-        r = requests.get(url, timeout=5, headers=headers, allow_redirects=True)
-        duration = int((time.time() - start_time) * 1000)
-        return True, str(r.status_code), duration
+        with requests.get(url, timeout=5, headers=headers, allow_redirects=True, stream=True) as r:
+            duration = int((time.time() - start_time) * 1000)
+            redirect = {
+                'final_url': r.url,
+                'hops': len(r.history),
+                'redirect_ms': int(sum(h.elapsed.total_seconds() for h in r.history) * 1000)
+            }
+            return finish(r, duration, redirect)
     except Exception as e:
-        return False, "Error", 0
+        return False, "Error", 0, None
+
+def check_tcp(domain, ports=(443, 80), timeout=2):
+    """TCP 连通性检测，任一端口可建立连接即视为存活；域名自带端口时只检测该端口"""
+    try:
+        parts = urlsplit(domain if '://' in domain else f'//{domain}')
+        host = parts.hostname
+        if parts.port: ports = (parts.port,)
+    except ValueError:
+        return False
+    if not host: return False
+    for port in ports:
+        try:
+            with socket.create_connection((host, port), timeout=timeout):
+                return True
+        except OSError:
+            continue
+    return False
+
+def probe_args(d, now):
+    """生成 check_website_detailed 的参数，便于在线程池中执行"""
+    cached_url = None
+    if d.final_url and d.redirect_checked and (now - d.redirect_checked).total_seconds() < REDIRECT_REVALIDATE:
+        cached_url = d.final_url
+    return d.domain_name, cached_url, content_rules(d)
+
+def apply_probe(d, result, now):
+    """把完整探测结果写回域名记录 (不提交事务)"""
+    online, code, ms, redirect = result
+    if redirect:
+        d.final_url = redirect['final_url']
+        d.redirect_hops = redirect['hops']
+        d.redirect_ms = redirect['redirect_ms']
+        d.redirect_checked = now
+    elif code == "Error":
+        # 完整探测也失败，清掉缓存，下次重新走跳转链
+        d.final_url = ""
+        d.redirect_checked = None
+    d.is_online = online
+    d.status_code = code
+    d.response_time = ms
+    d.last_checked = now
+    d.days_to_expire = calc_days(d.expiration_date)
+    d.check_tier = 'http'
+    d.last_deep_check = now
+    record_check(d, online, ms if online else None, now)
+    return online, code, ms
+
+def probe_domain(d):
+    """探测单个域名并写回状态字段 (不提交事务)"""
+    now = datetime.utcnow()
+    return apply_probe(d, check_website_detailed(*probe_args(d, now)), now)
+
+# --- SLA 统计 ---
+# 延迟分位数用对数分桶直方图估算 (可直接相加合并)，相对误差约 (GAMMA-1)/2
+SKETCH_GAMMA = 1.1
+# 窗口名: (分桶粒度, 桶数, 每桶秒数)
+SLA_WINDOWS = {'24h': ('h', 24, 3600), '7d': ('d', 7, 86400), '30d': ('d', 30, 86400)}
+# 各分桶粒度需保留的桶数与每桶秒数，由 SLA_WINDOWS 推出
+SLA_LEVELS = {}
+for _level, _span, _size in SLA_WINDOWS.values():
+    SLA_LEVELS[_level] = (max(_span, SLA_LEVELS.get(_level, (0, _size))[0]), _size)
+# 两次检测间隔超过此值的部分视为无数据，不计入在线/离线时长
+SLA_MAX_GAP = 2 * 3600
+
+def epoch(dt):
+    return (dt - datetime(1970, 1, 1)).total_seconds()
+
+def sketch_add(sketch, ms):
+    idx = int(math.ceil(math.log(ms, SKETCH_GAMMA))) if ms > 1 else 0
+    sketch[str(idx)] = sketch.get(str(idx), 0) + 1
+
+def sketch_quantile(sketch, q):
+    total = sum(sketch.values())
+    if not total: return None
+    rank = q * (total - 1)
+    seen = 0
+    for idx in sorted(sketch, key=int):
+        seen += sketch[idx]
+        if seen > rank:
+            i = int(idx)
+            return int(round(2 * SKETCH_GAMMA ** i / (SKETCH_GAMMA + 1))) if i > 0 else 1
+
+def new_bucket():
+    return {'n': 0, 'up_s': 0, 'down_s': 0, 'rec': 0, 'rec_s': 0, 'lat': {}}
+
+def add_interval(data, start, end, field):
+    """把 [start, end) 的秒数按分桶边界拆开，累加到各粒度的分桶"""
+    for level, (keep, size) in SLA_LEVELS.items():
+        buckets = data.setdefault(level, {})
+        t = start
+        while t < end:
+            key = int(t // size)
+            edge = min(end, (key + 1) * size)
+            b = buckets.setdefault(str(key), new_bucket())
+            b[field] = round(b[field] + edge - t, 1)
+            t = edge
+
+def sla_summary(data, now):
+    """合并各窗口内的分桶，得到按时长计算的可用率、延迟分位数与平均恢复时间 (MTTR, 秒)"""
+    out = {}
+    for name, (level, span, size) in SLA_WINDOWS.items():
+        current = int(epoch(now) // size)
+        agg = {'n': 0, 'up_s': 0, 'down_s': 0, 'rec': 0, 'rec_s': 0}
+        lat = {}
+        for key, b in data.get(level, {}).items():
+            if int(key) <= current - span: continue
+            for f in agg: agg[f] += b.get(f, 0)
+            for idx, c in b['lat'].items(): lat[idx] = lat.get(idx, 0) + c
+        observed = agg['up_s'] + agg['down_s']
+        out[name] = {
+            'checks': agg['n'],
+            'uptime': round(agg['up_s'] * 100 / observed, 2) if observed else None,
+            'p50': sketch_quantile(lat, 0.5),
+            'p95': sketch_quantile(lat, 0.95),
+            'p99': sketch_quantile(lat, 0.99),
+            'mttr': int(agg['rec_s'] / agg['rec']) if agg['rec'] else None
+        }
+    out['as_of'] = int(epoch(now))
+    return out
+
+def record_check(d, online, ms, now):
+    """把一次检测结果累加进分桶并刷新 SLA 摘要 (不提交事务)。ms 为 None 时不计延迟
+
+    可用率按时长统计: 上次检测到本次之间的时长计入上次的状态，手动刷新的次数不影响结果。
+    """
+    # 在写事务内重新读取统计行，避免探测期间持有的旧副本覆盖并发写入的新数据。
+    # 查询前的 autoflush 会先写入域名状态，SQLite 下借此持有写锁；其他数据库由 with_for_update 锁行
+    st = (DomainStats.query.filter_by(domain_id=d.id)
+          .with_for_update().populate_existing().first())
+    if st is None:
+        st = d.stats = DomainStats(domain_id=d.id)
+    data = json.loads(st.buckets or '{}')
+    ts = epoch(now)
+
+    if st.last_at and st.last_online is not None:
+        start = max(epoch(st.last_at), ts - SLA_MAX_GAP)
+        add_interval(data, start, ts, 'up_s' if st.last_online else 'down_s')
+    st.last_at = now
+    st.last_online = online
+
+    # 故障开始时记下时间，恢复时把持续时长计入恢复所在的分桶
+    recovered = None
+    if online:
+        if st.down_since:
+            recovered = int((now - st.down_since).total_seconds())
+            st.down_since = None
+    elif not st.down_since:
+        st.down_since = now
+
+    for level, (keep, size) in SLA_LEVELS.items():
+        buckets = data.setdefault(level, {})
+        current = int(ts // size)
+        b = buckets.setdefault(str(current), new_bucket())
+        b['n'] += 1
+        if ms is not None: sketch_add(b['lat'], ms)
+        if recovered is not None:
+            b['rec'] += 1
+            b['rec_s'] += recovered
+        for key in [k for k in buckets if int(k) <= current - keep]:
+            del buckets[key]
+
+    st.buckets = json.dumps(data, separators=(',', ':'))
+    d.sla = json.dumps(sla_summary(data, now))
+
+# 分层巡检参数
+SWEEP_BATCH = 5000
+SWEEP_TCP_WORKERS = 200
+SWEEP_HTTP_WORKERS = 20
+DEEP_CHECK_INTERVAL = 3600
+SWEEP_LEASE = 3600  # 每批次续约；进程异常退出时租约到期自动释放
+
+def acquire_sweep_lease():
+    """通过数据库原子更新抢占巡检租约，跨进程有效 (cron 与 Web 进程)。
+    成功时返回租约时间戳 (作为持有凭证)，已被占用时返回 None"""
+    now = datetime.utcnow()
+    get_config()
+    res = db.session.execute(
+        db.update(Config)
+        .where(db.or_(Config.sweep_started.is_(None), Config.sweep_started < now - timedelta(seconds=SWEEP_LEASE)))
+        .values(sweep_started=now))
+    db.session.commit()
+    return now if res.rowcount > 0 else None
+
+def renew_sweep_lease(lease):
+    """续约并返回新的时间戳；租约已过期被他人接管时抛出 RuntimeError"""
+    now = datetime.utcnow()
+    res = db.session.execute(db.update(Config).where(Config.sweep_started == lease).values(sweep_started=now))
+    db.session.commit()
+    if not res.rowcount:
+        raise RuntimeError('巡检租约已失效，本次巡检中止')
+    return now
+
+def release_sweep_lease(lease):
+    """只释放自己持有的租约"""
+    db.session.rollback()
+    db.session.execute(db.update(Config).where(Config.sweep_started == lease).values(sweep_started=None))
+    db.session.commit()
+
+def run_sweep(job=None):
+    """分层巡检: 先对全部域名做高并发 TCP 连接检测，再只对连通性变化、
+    到期需深度检测或处于故障状态的域名做完整 HTTP 探测。按批次提交，避免一次载入全部记录。"""
+    lease = acquire_sweep_lease()
+    if not lease:
+        raise RuntimeError('已有巡检正在进行')
+    summary = {'total': 0, 'tcp': 0, 'http': 0}
+    try:
+        count = Domain.query.count()
+        last_id = 0
+        with ThreadPoolExecutor(SWEEP_TCP_WORKERS) as tcp_pool, ThreadPoolExecutor(SWEEP_HTTP_WORKERS) as http_pool:
+            while True:
+                lease = renew_sweep_lease(lease)
+                last_id = sweep_batch(last_id, tcp_pool, http_pool, summary)
+                if last_id is None: break
+                job_progress(job, min(99, summary['total'] * 100 // max(count, 1)), f"已检测 {summary['total']}/{count}")
+    finally:
+        release_sweep_lease(lease)
+    return summary
+
+def sweep_batch(last_id, tcp_pool, http_pool, summary):
+    """巡检 id 大于 last_id 的一批域名，返回本批最大 id，没有剩余域名时返回 None"""
+    domains = Domain.query.filter(Domain.id > last_id).order_by(Domain.id.asc()).limit(SWEEP_BATCH).all()
+    if not domains: return None
+    now = datetime.utcnow()
+    # 探测耗时较长，只保留快照，不让 ORM 对象跨越探测期间
+    snapshot = [(d.id, d.domain_name, d.tcp_alive, d.last_deep_check, d.is_online, probe_args(d, now))
+                for d in domains]
+    db.session.rollback()
+
+    alive_list = list(tcp_pool.map(check_tcp, [s[1] for s in snapshot]))
+    deep, shallow = [], []
+    for (did, name, tcp_alive, last_deep, is_online, args), alive in zip(snapshot, alive_list):
+        due = not last_deep or (now - last_deep).total_seconds() >= DEEP_CHECK_INTERVAL
+        if alive != tcp_alive or due or not alive or not is_online:
+            deep.append((did, alive, args))
+        else:
+            shallow.append((did, alive))
+
+    results = list(http_pool.map(lambda item: check_website_detailed(*item[2]), deep))
+    updates = [(did, alive, None) for did, alive in shallow]
+    updates += [(did, alive, result) for (did, alive, _), result in zip(deep, results)]
+    for did, alive, result in updates:
+        save_sweep_result(did, alive, result, now)
+
+    summary['total'] += len(snapshot)
+    summary['http'] += len(deep)
+    summary['tcp'] += len(shallow)
+    return snapshot[-1][0]
+
+def save_sweep_result(did, alive, result, now):
+    """重新读取域名并写回单个巡检结果 (result 为 None 表示仅 TCP)。
+    期间被删除或与手动刷新冲突的记录直接跳过，不影响其余域名。"""
+    try:
+        d = db.session.get(Domain, did)
+        if d is None: return
+        d.tcp_alive = alive
+        if result is None:
+            d.check_tier = 'tcp'
+            d.last_checked = now
+            record_check(d, True, None, now)
+        else:
+            apply_probe(d, result, now)
+        db.session.commit()
+    except (StaleDataError, IntegrityError):
+        db.session.rollback()
+
+def sweep_job(job):
+    s = run_sweep(job)
+    return f"巡检完成: 共 {s['total']} 个，仅 TCP {s['tcp']} 个，HTTP 探测 {s['http']} 个"
 
 def calc_days(exp_date_str):
     if not exp_date_str: return 0
@@ -114,7 +522,8 @@ def index():
         'issue': sum(1 for d in domains if not d.is_online and d.status_code != 'N/A'),
         'soon': sum(1 for d in domains if d.days_to_expire < 30)
     }
-    return render_template_string(HTML_TEMPLATE, domains=domains, stats=stats, config=conf)
+    return render_template_string(HTML_TEMPLATE, domains=domains, stats=stats, config=conf,
+                                  now_ts=int(epoch(datetime.utcnow())))
 
 # --- API: 域名操作 ---
 
@@ -134,6 +543,7 @@ def api_add_bulk():
                 db.session.add(Domain(domain_name=clean, position=max_pos))
                 count += 1
     db.session.commit()
+    schedule_auto_backup()
     return jsonify({'status': 'success', 'count': count})
 
 @app.route('/api/refresh/<int:id>', methods=['POST'])
@@ -141,14 +551,26 @@ def api_add_bulk():
 def api_refresh(id):
     d = Domain.query.get(id)
     if not d: return jsonify({'status':'error'})
-    online, code, ms = check_website_detailed(d.domain_name)
-    d.is_online = online
-    d.status_code = code
-    d.response_time = ms
-    d.last_checked = datetime.utcnow()
-    d.days_to_expire = calc_days(d.expiration_date)
+    online, code, ms = probe_domain(d)
     db.session.commit()
-    return jsonify({'status': 'success', 'online': online, 'code': code, 'ms': ms})
+    return jsonify({'status': 'success', 'online': online, 'code': code, 'ms': ms,
+                    'hops': d.redirect_hops or 0, 'redirect_ms': d.redirect_ms or 0, 'tier': d.check_tier,
+                    'sla': d.sla_stats})
+
+@app.route('/api/stats/<int:id>')
+@login_required
+def api_stats(id):
+    """按当前时间重新合并分桶，窗口随时间滚动，不依赖最近一次探测"""
+    d = Domain.query.get(id)
+    if not d: return jsonify({'status':'error'})
+    data = json.loads(d.stats.buckets) if d.stats else {}
+    return jsonify({'status': 'success', 'domain': d.domain_name, 'sla': sla_summary(data, datetime.utcnow())})
+
+@app.route('/api/sweep', methods=['POST'])
+@login_required
+def api_sweep():
+    job_id = submit_job('sweep', sweep_job)
+    return jsonify({'status': 'success', 'job_id': job_id, 'msg': '任务已提交'})
 
 @app.route('/api/delete/<int:id>', methods=['POST'])
 @login_required
@@ -157,6 +579,7 @@ def api_delete(id):
     if d:
         db.session.delete(d)
         db.session.commit()
+        schedule_auto_backup()
         return jsonify({'status':'success'})
     return jsonify({'status':'error'})
 
@@ -165,12 +588,38 @@ def api_delete(id):
 def api_edit():
     d = Domain.query.get(request.form.get('id'))
     if d:
-        d.domain_name = request.form.get('domain_name')
+        assert_regex = request.form.get('assert_regex') == '1'
+        must_contain = request.form.get('must_contain', '')
+        must_not_contain = request.form.get('must_not_contain', '')
+        if assert_regex:
+            try:
+                re.compile(must_contain)
+                re.compile(must_not_contain)
+            except re.error as e:
+                return jsonify({'status':'error', 'msg': f'正则无效: {e}'})
+        domain_name = request.form.get('domain_name')
+        if domain_name != d.domain_name:
+            # 域名变更后旧的跳转缓存与巡检状态不再适用
+            d.final_url = ""
+            d.redirect_checked = None
+            d.redirect_hops = 0
+            d.redirect_ms = 0
+            d.tcp_alive = None
+            d.last_deep_check = None
+        d.domain_name = domain_name
         d.remark = request.form.get('remark')
         d.registration_date = request.form.get('reg_date')
         d.expiration_date = request.form.get('exp_date')
         d.days_to_expire = calc_days(d.expiration_date)
+        d.must_contain = must_contain
+        d.must_not_contain = must_not_contain
+        d.assert_regex = assert_regex
+        try:
+            d.max_body_kb = int(request.form.get('max_body_kb') or 0)
+        except ValueError:
+            d.max_body_kb = 0
         db.session.commit()
+        schedule_auto_backup()
     return jsonify({'status':'success'})
 
 @app.route('/api/reorder', methods=['POST'])
@@ -193,6 +642,7 @@ def save_config():
     conf.webdav_url = request.form.get('webdav_url', '')
     conf.webdav_user = request.form.get('webdav_user', '')
     conf.webdav_pass = request.form.get('webdav_pass', '')
+    conf.auto_backup = request.form.get('auto_backup') == '1'
     db.session.commit()
     return jsonify({'status':'success', 'msg':'配置已保存'})
 
@@ -203,60 +653,202 @@ def get_backup_json():
         for d in domains
     ], indent=2, ensure_ascii=False)
 
+# --- 后台任务 (云端备份/恢复不阻塞请求线程) ---
+
+CLOUD_TIMEOUT = (5, 30)   # (连接, 读取) 超时秒数
+CLOUD_RETRIES = 3
+CLOUD_RETRY_STATUS = {429, 500, 502, 503, 504}
+# 可安全重发的方法 (Gist PATCH 提交的是完整内容，重复执行结果相同)
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'PUT', 'PATCH', 'DELETE'}
+AUTO_BACKUP_DELAY = 60    # 最后一次修改后多久触发自动备份
+AUTO_BACKUP_MAX_WAIT = 600  # 持续修改时最长推迟时间
+
+JOBS = {}
+JOBS_LOCK = threading.Lock()
+_auto_backup = {'timer': None, 'first': 0}
+# 同一目标的导出串行执行 (手动与自动备份共用)，避免并发 POST 重复创建 Gist
+EXPORT_LOCKS = {'gist': threading.Lock(), 'webdav': threading.Lock()}
+
+class CloudError(Exception):
+    pass
+
+def job_progress(job, progress=None, msg=None):
+    if job is None: return
+    with JOBS_LOCK:
+        if progress is not None: job['progress'] = progress
+        if msg is not None: job['msg'] = msg
+
+def _run_job(job, fn):
+    job_progress(job, 0, '执行中')
+    with JOBS_LOCK: job['state'] = 'running'
+    with app.app_context():
+        try:
+            msg = fn(job)
+            state = 'success'
+        except Exception as e:
+            msg, state = str(e), 'error'
+        finally:
+            db.session.remove()
+    with JOBS_LOCK:
+        job.update(state=state, progress=100, msg=msg, finished=time.time())
+
+def submit_job(kind, fn):
+    """在后台线程中执行 fn(job)，返回任务ID。fn 的返回值作为完成提示，抛出异常视为失败"""
+    now = time.time()
+    job = {'id': uuid.uuid4().hex[:12], 'kind': kind, 'state': 'pending', 'progress': 0, 'msg': '排队中', 'created': now}
+    with JOBS_LOCK:
+        # 清理一小时前已结束的任务
+        for jid in [k for k, v in JOBS.items() if v.get('finished', now) < now - 3600]:
+            del JOBS[jid]
+        JOBS[job['id']] = job
+    threading.Thread(target=_run_job, args=(job, fn), daemon=True).start()
+    return job['id']
+
+def cloud_request(method, url, job=None, **kwargs):
+    """带超时与指数退避重试的云端请求
+
+    幂等请求在网络错误及 CLOUD_RETRY_STATUS 时重试；POST 等非幂等请求只在连接超时
+    (请求尚未发出) 时重试，避免服务端已处理后重复提交 (如重复创建 Gist)。
+    """
+    idempotent = method.upper() in IDEMPOTENT_METHODS
+    for attempt in range(1, CLOUD_RETRIES + 1):
+        try:
+            r = requests.request(method, url, timeout=CLOUD_TIMEOUT, **kwargs)
+            if not idempotent or r.status_code not in CLOUD_RETRY_STATUS:
+                return r
+            err = f'HTTP {r.status_code}'
+        except requests.ConnectTimeout as e:
+            r, err = None, str(e)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if not idempotent:
+                raise CloudError(f'网络请求失败: {e}')
+            r, err = None, str(e)
+        if attempt == CLOUD_RETRIES:
+            if r is not None: return r
+            raise CloudError(f'网络请求失败: {err}')
+        delay = 2 ** attempt
+        job_progress(job, msg=f'{err}，{delay}s 后重试 ({attempt}/{CLOUD_RETRIES})')
+        time.sleep(delay)
+
+def schedule_auto_backup():
+    """防抖自动备份: 连续修改合并为一次上传，最长推迟 AUTO_BACKUP_MAX_WAIT 秒"""
+    if not get_config().auto_backup: return
+    with JOBS_LOCK:
+        now = time.time()
+        timer = _auto_backup['timer']
+        if timer and timer.is_alive():
+            if now - _auto_backup['first'] >= AUTO_BACKUP_MAX_WAIT:
+                return  # 已到最长等待，保持原定时，届时会带上本次修改
+            timer.cancel()
+        else:
+            _auto_backup['first'] = now
+        delay = max(0, min(AUTO_BACKUP_DELAY, _auto_backup['first'] + AUTO_BACKUP_MAX_WAIT - now))
+        timer = threading.Timer(delay, run_auto_backup)
+        timer.daemon = True
+        timer.start()
+        _auto_backup['timer'] = timer
+
+def run_auto_backup():
+    with app.app_context():
+        conf = get_config()
+        if conf.gist_token: submit_job('gist_export', gist_export)
+        if conf.webdav_url: submit_job('webdav_export', webdav_export)
+        db.session.remove()
+
+def gist_headers(conf):
+    return {
+        'Authorization': f'token {conf.gist_token}',
+        'Accept': 'application/vnd.github.v3+json'
+    }
+
+def gist_export(job):
+    job_progress(job, msg='等待其他 Gist 备份完成')
+    with EXPORT_LOCKS['gist']:
+        return _gist_export(job)
+
+def _gist_export(job):
+    # 在锁内读取配置，拿到前一个任务刚保存的 gist_id
+    conf = get_config()
+    headers = gist_headers(conf)
+    job_progress(job, 10, '正在生成备份')
+    payload = {
+        "description": "Domain Monitor Backup",
+        "public": False,
+        "files": {"domains_backup.json": {"content": get_backup_json()}}
+    }
+
+    # 如果已有ID，尝试更新 (PATCH)
+    if conf.gist_id:
+        job_progress(job, 40, '正在更新 Gist')
+        r = cloud_request('PATCH', f"https://api.github.com/gists/{conf.gist_id}", job, json=payload, headers=headers)
+        if r.status_code == 200:
+            return 'Gist 更新成功'
+        if r.status_code != 404:
+            raise CloudError(f'GitHub API Error: {r.status_code}')
+        conf.gist_id = ""  # ID失效，转为新建
+
+    job_progress(job, 60, '正在创建 Gist')
+    r = cloud_request('POST', "https://api.github.com/gists", job, json=payload, headers=headers)
+    if r.status_code == 201:
+        conf.gist_id = r.json()['id']
+        db.session.commit()
+        return '新 Gist 创建成功'
+    raise CloudError(f'GitHub API Error: {r.status_code}')
+
+def gist_import(job):
+    conf = get_config()
+    job_progress(job, 20, '正在下载 Gist')
+    r = cloud_request('GET', f"https://api.github.com/gists/{conf.gist_id}", job, headers=gist_headers(conf))
+    if r.status_code == 200:
+        files = r.json()['files']
+        if 'domains_backup.json' in files:
+            job_progress(job, 70, '正在导入')
+            import_data_logic(json.loads(files['domains_backup.json']['content']))
+            return '从 Gist 恢复成功'
+    raise CloudError('获取 Gist 失败')
+
+def webdav_target(conf):
+    return conf.webdav_url.rstrip('/') + '/domains_backup.json', (conf.webdav_user, conf.webdav_pass)
+
+def webdav_export(job):
+    job_progress(job, msg='等待其他 WebDAV 备份完成')
+    with EXPORT_LOCKS['webdav']:
+        return _webdav_export(job)
+
+def _webdav_export(job):
+    url, auth = webdav_target(get_config())
+    job_progress(job, 10, '正在生成备份')
+    data = get_backup_json()
+    job_progress(job, 40, '正在上传')
+    r = cloud_request('PUT', url, job, data=data.encode('utf-8'), auth=auth)
+    if r.status_code in [200, 201, 204]:
+        return 'WebDAV 上传成功'
+    raise CloudError(f'WebDAV Error: {r.status_code}')
+
+def webdav_import(job):
+    url, auth = webdav_target(get_config())
+    job_progress(job, 20, '正在下载')
+    r = cloud_request('GET', url, job, auth=auth)
+    if r.status_code == 200:
+        job_progress(job, 70, '正在导入')
+        import_data_logic(r.json())
+        return '从 WebDAV 恢复成功'
+    raise CloudError(f'WebDAV Error: {r.status_code}')
+
 @app.route('/api/gist/<action>', methods=['POST'])
 @login_required
 def gist_action(action):
     conf = get_config()
     if not conf.gist_token:
         return jsonify({'status':'error', 'msg':'请先点击⚙️配置 Gist Token'})
-    
-    headers = {
-        'Authorization': f'token {conf.gist_token}',
-        'Accept': 'application/vnd.github.v3+json'
-    }
-    
     if action == 'export':
-        content = get_backup_json()
-        payload = {
-            "description": "Domain Monitor Backup",
-            "public": False,
-            "files": {"domains_backup.json": {"content": content}}
-        }
-        
-        try:
-            # 如果已有ID，尝试更新 (PATCH)
-            if conf.gist_id:
-                r = requests.patch(f"https://api.github.com/gists/{conf.gist_id}", json=payload, headers=headers)
-                if r.status_code == 404: # ID失效，转为新建
-                    conf.gist_id = "" 
-                else:
-                    return jsonify({'status':'success', 'msg':'Gist 更新成功'})
-            
-            # 如果没有ID或更新失败，新建 (POST)
-            if not conf.gist_id:
-                r = requests.post("https://api.github.com/gists", json=payload, headers=headers)
-                if r.status_code == 201:
-                    conf.gist_id = r.json()['id']
-                    db.session.commit()
-                    return jsonify({'status':'success', 'msg':'新 Gist 创建成功'})
-                
-            return jsonify({'status':'error', 'msg': f'GitHub API Error: {r.status_code}'})
-        except Exception as e:
-            return jsonify({'status':'error', 'msg': str(e)})
-
+        job_id = submit_job('gist_export', gist_export)
     elif action == 'import':
         if not conf.gist_id: return jsonify({'status':'error', 'msg':'未找到绑定的 Gist ID，请先执行一次导出'})
-        try:
-            r = requests.get(f"https://api.github.com/gists/{conf.gist_id}", headers=headers)
-            if r.status_code == 200:
-                files = r.json()['files']
-                if 'domains_backup.json' in files:
-                    data = json.loads(files['domains_backup.json']['content'])
-                    import_data_logic(data)
-                    return jsonify({'status':'success', 'msg':'从 Gist 恢复成功'})
-            return jsonify({'status':'error', 'msg':'获取 Gist 失败'})
-        except Exception as e:
-            return jsonify({'status':'error', 'msg': str(e)})
+        job_id = submit_job('gist_import', gist_import)
+    else:
+        return jsonify({'status':'error', 'msg':'未知操作'})
+    return jsonify({'status':'success', 'job_id': job_id, 'msg':'任务已提交'})
 
 @app.route('/api/webdav/<action>', methods=['POST'])
 @login_required
@@ -264,26 +856,21 @@ def webdav_action(action):
     conf = get_config()
     if not conf.webdav_url:
         return jsonify({'status':'error', 'msg':'请先点击⚙️配置 WebDAV 信息'})
-    
-    url = conf.webdav_url.rstrip('/') + '/domains_backup.json'
-    auth = (conf.webdav_user, conf.webdav_pass)
-    
-    try:
-        if action == 'export':
-            data = get_backup_json()
-            r = requests.put(url, data=data.encode('utf-8'), auth=auth)
-            if r.status_code in [200, 201, 204]:
-                return jsonify({'status':'success', 'msg':'WebDAV 上传成功'})
-            return jsonify({'status':'error', 'msg':f'WebDAV Error: {r.status_code}'})
-            
-        elif action == 'import':
-            r = requests.get(url, auth=auth)
-            if r.status_code == 200:
-                import_data_logic(r.json())
-                return jsonify({'status':'success', 'msg':'从 WebDAV 恢复成功'})
-            return jsonify({'status':'error', 'msg':f'WebDAV Error: {r.status_code}'})
-    except Exception as e:
-        return jsonify({'status':'error', 'msg':str(e)})
+    if action == 'export':
+        job_id = submit_job('webdav_export', webdav_export)
+    elif action == 'import':
+        job_id = submit_job('webdav_import', webdav_import)
+    else:
+        return jsonify({'status':'error', 'msg':'未知操作'})
+    return jsonify({'status':'success', 'job_id': job_id, 'msg':'任务已提交'})
+
+@app.route('/api/job/<job_id>')
+@login_required
+def job_status(job_id):
+    with JOBS_LOCK:
+        job = dict(JOBS[job_id]) if job_id in JOBS else None
+    if not job: return jsonify({'status':'error', 'msg':'任务不存在或已过期'})
+    return jsonify({'status':'success', **job})
 
 def import_data_logic(data_list):
     """通用导入逻辑"""
@@ -333,13 +920,34 @@ def import_file():
                     db.session.add(Domain(domain_name=d, position=9999))
                     count += 1
             db.session.commit()
+        schedule_auto_backup()
         return jsonify({'status':'success', 'msg':'导入完成'})
     except Exception as e:
         return jsonify({'status':'error', 'msg':str(e)})
 
+def upgrade_schema():
+    """为旧数据库补齐新增列 (create_all 不会修改已存在的表)"""
+    insp = db.inspect(db.engine)
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            existing = {c['name'] for c in insp.get_columns(table.name)}
+            for col in table.columns:
+                if col.name not in existing:
+                    col_type = col.type.compile(dialect=db.engine.dialect)
+                    conn.execute(db.text(f'ALTER TABLE {table.name} ADD COLUMN {col.name} {col_type}'))
+
+@app.cli.command('sweep')
+def sweep_command():
+    """分层巡检全部域名 (适合 cron 定时执行)"""
+    try:
+        print(sweep_job(None))
+    except RuntimeError as e:
+        print(e)
+
 # 初始化
 with app.app_context():
     db.create_all()
+    upgrade_schema()
 
 # --- 模板 ---
 
@@ -488,6 +1096,7 @@ HTML_TEMPLATE = """
         <div style="display:flex; gap:10px;">
             <button onclick="document.getElementById('addModal').style.display='block'" class="btn btn-primary"><i class="fas fa-plus"></i> 添加域名</button>
             <button onclick="batchRefresh()" class="btn btn-success" style="background:#0984e3"><i class="fas fa-sync"></i> 刷新状态</button>
+            <button onclick="runSweep()" class="btn btn-grey"><i class="fas fa-bolt"></i> 快速巡检</button>
         </div>
         <button onclick="batchDelete()" class="btn btn-danger"><i class="fas fa-trash"></i> 批量删除</button>
     </div>
@@ -501,13 +1110,14 @@ HTML_TEMPLATE = """
                     <th width="30"></th>
                     <th>域名 / 备注</th>
                     <th>状态</th>
+                    <th class="hide-mobile">可用率 (24h)</th>
                     <th class="hide-mobile">到期</th>
                     <th style="text-align:right">操作</th>
                 </tr>
             </thead>
             <tbody id="domainList">
                 {% for d in domains %}
-                <tr data-id="{{ d.id }}">
+                <tr data-id="{{ d.id }}" data-contain="{{ d.must_contain or '' }}" data-not-contain="{{ d.must_not_contain or '' }}" data-regex="{{ 1 if d.assert_regex else 0 }}" data-max-kb="{{ d.max_body_kb or 0 }}">
                     <td><input type="checkbox" class="chk" value="{{ d.id }}"></td>
                     <td class="drag-handle" style="cursor:grab; color:#666;"><i class="fas fa-grip-lines"></i></td>
                     <td>
@@ -517,12 +1127,27 @@ HTML_TEMPLATE = """
                     <td id="status-{{ d.id }}">
                         {% if d.is_online %}
                             <span class="status-badge badge-ok">200 OK</span> <small>{{ d.response_time }}ms</small>
+                            {% if d.check_tier == 'tcp' %}<small style="color:#888;" title="最近一次为 TCP 快速检测">TCP</small>{% endif %}
+                            {% if d.redirect_hops %}<small style="color:#888;" title="{{ d.final_url }}">↪{{ d.redirect_hops }} / {{ d.redirect_ms }}ms</small>{% endif %}
                         {% elif d.status_code != 'N/A' %}
                             <span class="status-badge badge-err">{{ d.status_code }}</span>
                         {% else %}
                             <span style="color:#666">-</span>
                         {% endif %}
                     </td>
+                    {% set sla = d.sla_stats %}
+                    {# 摘要在写入时计算，超过 24 小时未检测则窗口已过期，不再展示 #}
+                    {% set sla_age = now_ts - sla.get('as_of', 0) %}
+                    <td class="hide-mobile" id="sla-{{ d.id }}">
+                        {% if sla and sla['24h'].uptime is not none and sla_age < 86400 %}
+                            <span title="统计于 {{ sla_age // 60 }} 分钟前&#10;7天: {{ sla['7d'].uptime }}% / p95 {{ sla['7d'].p95 }}ms&#10;30天: {{ sla['30d'].uptime }}% / p95 {{ sla['30d'].p95 }}ms / MTTR {{ sla['30d'].mttr or '-' }}s">{{ sla['24h'].uptime }}%</span>
+                            <div style="font-size:0.75em; color:#888;">p50 {{ sla['24h'].p50 or '-' }} / p95 {{ sla['24h'].p95 or '-' }} / p99 {{ sla['24h'].p99 or '-' }} ms</div>
+                        {% elif sla %}
+                            <span style="color:#666" title="超过 24 小时未检测或数据不足">-</span>
+                        {% else %}
+                            <span style="color:#666">-</span>
+                        {% endif %}
+                    </td>
                     <td class="hide-mobile">
                         {% if d.days_to_expire < 30 %}
                             <span style="color:var(--danger)">{{ d.days_to_expire }} 天</span>
@@ -566,6 +1191,10 @@ HTML_TEMPLATE = """
         <label>备注</label><input type="text" id="editRemark">
         <label>注册日期</label><input type="text" id="editReg">
         <label>到期日期</label><input type="text" id="editExp">
+        <label>页面必须包含 (可选)</label><input type="text" id="editContain">
+        <label>页面不得包含 (可选)</label><input type="text" id="editNotContain">
+        <label><input type="checkbox" id="editRegex" style="width:auto;margin:0 5px 0 0;">按正则匹配</label>
+        <label>最大页面体积 KB (0 为不限)</label><input type="number" id="editMaxKb" min="0">
         <div style="text-align:right;">
             <button onclick="document.getElementById('editModal').style.display='none'" class="btn btn-grey">取消</button>
             <button onclick="submitEdit()" class="btn btn-primary">保存</button>
@@ -590,6 +1219,7 @@ HTML_TEMPLATE = """
                 <label>密码 (或应用密码)</label>
                 <input type="password" name="webdav_pass" value="{{ config.webdav_pass }}">
             </div>
+            <label><input type="checkbox" name="auto_backup" value="1" style="width:auto;margin:0 5px 0 0;" {% if config.auto_backup %}checked{% endif %}>修改后自动备份到已配置的云端</label>
         </form>
         <div style="text-align:right; margin-top:15px;">
             <button onclick="document.getElementById('configModal').style.display='none'" class="btn btn-grey">取消</button>
@@ -647,16 +1277,34 @@ HTML_TEMPLATE = """
         btn.innerText = '执行中...';
         btn.disabled = true;
 
+        const reset = () => {
+            btn.innerText = oldTxt;
+            btn.disabled = false;
+        };
+
         fetch(`/api/${service}/${action}`, {method:'POST'})
         .then(r=>r.json())
         .then(res => {
-            alert(res.msg);
-            if(res.status === 'success' && action === 'import') location.reload();
+            if(res.status !== 'success') { reset(); return alert(res.msg); }
+            pollJob(res.job_id, btn, job => {
+                reset();
+                alert(job.msg);
+                if(job.state === 'success' && action === 'import') location.reload();
+            });
         })
-        .finally(() => {
-            btn.innerText = oldTxt;
-            btn.disabled = false;
-        });
+        .catch(reset);
+    }
+
+    // 轮询后台任务状态直到结束，期间在按钮上显示进度
+    function pollJob(jobId, btn, done) {
+        fetch('/api/job/'+jobId).then(r=>r.json()).then(job => {
+            if(job.state === 'pending' || job.state === 'running') {
+                btn.innerText = `${job.progress}% ${job.msg}`;
+                setTimeout(() => pollJob(jobId, btn, done), 1000);
+                return;
+            }
+            done(job);
+        }).catch(() => done({state: 'error', msg: '查询任务状态失败'}));
     }
 
     // --- 基础功能 ---
@@ -689,12 +1337,33 @@ HTML_TEMPLATE = """
                 fetch('/api/refresh/'+c.value, {method:'POST'}).then(r=>r.json()).then(d=>{
                     const cls = d.online ? 'badge-ok' : 'badge-err';
                     const txt = d.online ? '200 OK' : d.code;
-                    document.getElementById('status-'+c.value).innerHTML = `<span class="status-badge ${cls}">${txt}</span> <small>${d.ms}ms</small>`;
+                    const hops = d.hops ? ` <small style="color:#888;">↪${d.hops} / ${d.redirect_ms}ms</small>` : '';
+                    document.getElementById('status-'+c.value).innerHTML = `<span class="status-badge ${cls}">${txt}</span> <small>${d.ms}ms</small>${hops}`;
+                    const s = d.sla && d.sla['24h'];
+                    if(s && s.uptime !== null) document.getElementById('sla-'+c.value).innerHTML = `${s.uptime}%<div style="font-size:0.75em; color:#888;">p50 ${s.p50||'-'} / p95 ${s.p95||'-'} / p99 ${s.p99||'-'} ms</div>`;
                 });
             }, idx * 200);
         });
     }
 
+    function runSweep() {
+        const btn = event.currentTarget;
+        const oldHtml = btn.innerHTML;
+        const reset = () => {
+            btn.innerHTML = oldHtml;
+            btn.disabled = false;
+        };
+        btn.disabled = true;
+        fetch('/api/sweep', {method:'POST'}).then(r=>r.json()).then(res=>{
+            if(res.status !== 'success') { reset(); return alert(res.msg); }
+            pollJob(res.job_id, btn, job => {
+                reset();
+                alert(job.msg);
+                if(job.state === 'success') location.reload();
+            });
+        }).catch(reset);
+    }
+
     function delOne(id) { if(confirm('删除?')) fetch('/api/delete/'+id, {method:'POST'}).then(()=>location.reload()); }
     function batchDelete() {
         const checks = document.querySelectorAll('.chk:checked');
@@ -732,6 +1401,11 @@ HTML_TEMPLATE = """
         document.getElementById('editModal').style.display='block';
         document.getElementById('editId').value = id;
         document.getElementById('editDomain').value = name;
+        const row = document.querySelector(`tr[data-id="${id}"]`).dataset;
+        document.getElementById('editContain').value = row.contain;
+        document.getElementById('editNotContain').value = row.notContain;
+        document.getElementById('editRegex').checked = row.regex === '1';
+        document.getElementById('editMaxKb').value = row.maxKb;
     }
     function submitEdit() {
         const fd = new FormData();
@@ -740,7 +1414,14 @@ HTML_TEMPLATE = """
         fd.append('remark', document.getElementById('editRemark').value);
         fd.append('reg_date', document.getElementById('editReg').value);
         fd.append('exp_date', document.getElementById('editExp').value);
-        fetch('/api/edit', {method:'POST', body:fd}).then(()=>location.reload());
+        fd.append('must_contain', document.getElementById('editContain').value);
+        fd.append('must_not_contain', document.getElementById('editNotContain').value);
+        fd.append('assert_regex', document.getElementById('editRegex').checked ? '1' : '0');
+        fd.append('max_body_kb', document.getElementById('editMaxKb').value);
+        fetch('/api/edit', {method:'POST', body:fd}).then(r=>r.json()).then(res=>{
+            if(res.status === 'error') return alert(res.msg);
+            location.reload();
+        });
     }
     
     // 点击外部关闭弹窗